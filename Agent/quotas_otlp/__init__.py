@@ -0,0 +1 @@
+"""GCP quota exporter shared by the standalone and Cloud Functions entry points."""
@@ -0,0 +1,329 @@
+# coding: utf-8
+"""Shared quota fetching and OTLP export logic for the exporter entry points."""
+
+import os
+import time
+import asyncio
+import csv
+import itertools
+from sys import intern
+from google.cloud import monitoring_v3
+from opentelemetry import metrics
+from opentelemetry.metrics import Observation
+from opentelemetry.sdk.metrics import MeterProvider
+from opentelemetry.sdk.metrics.export import PeriodicExportingMetricReader
+from grpc import Compression
+from opentelemetry.exporter.otlp.proto.grpc.metric_exporter import OTLPMetricExporter
+from opentelemetry.sdk.resources import Resource
+
+# --- Configuration ---
+# OTLP gRPC Endpoint (LOCAL); a single HTTP/2 channel is kept open across exports
+OTLP_ENDPOINT = "localhost:4317"
+# Quota attribute strings are highly repetitive, so gzip shrinks exports considerably
+exporter = OTLPMetricExporter(endpoint=OTLP_ENDPOINT, insecure=True, timeout=10, compression=Compression.Gzip)
+
+# Quota values only change when a project is polled (every few minutes),
+# so exporting more often than this just resends the same snapshot
+EXPORT_INTERVAL_MILLIS = 30000
+EXPORT_TIMEOUT_MILLIS = 10000
+
+# Maximum number of Cloud Monitoring requests in flight at any one time
+MAX_CONCURRENT_REQUESTS = 10
+
+# Shared Cloud Monitoring client and request semaphore; both are created
+# lazily so they are bound to the running event loop and reused across all
+# requests
+_monitoring_client = None
+_request_semaphore = None
+
+# Cloud Monitoring metric types for quota usage and limits
+ALLOCATION_USAGE_METRIC = "serviceruntime.googleapis.com/quota/allocation/usage"
+RATE_USAGE_METRIC = "serviceruntime.googleapis.com/quota/rate/net_usage"
+QUOTA_LIMIT_METRIC = "serviceruntime.googleapis.com/quota/limit"
+USAGE_METRICS_BY_QUOTA_TYPE = {
+    "allocation": ALLOCATION_USAGE_METRIC,
+    "rate": RATE_USAGE_METRIC,
+}
+
+# How far back to look for points: usage is reported frequently, while
+# limits are only sampled about once a day
+USAGE_WINDOW_SECONDS = 50000
+LIMIT_WINDOW_SECONDS = 86400
+
+# Quota types checked for projects whose config has no metrics_to_check
+DEFAULT_METRICS_TO_CHECK = "allocation,rate"
+
+# Quota limits rarely change, so they are cached per project and only
+# re-fetched once they are older than LIMIT_CACHE_TTL seconds
+LIMIT_CACHE_TTL = 1800
+_limit_cache = {}
+
+# Configure the OpenTelemetry MeterProvider with OTLP exporter
+resource = Resource(attributes={"service.name": "gcp-quota-exporter"})
+reader = PeriodicExportingMetricReader(
+    exporter,
+    export_interval_millis=EXPORT_INTERVAL_MILLIS,
+    export_timeout_millis=EXPORT_TIMEOUT_MILLIS,
+)
+meter_provider = MeterProvider(resource=resource, metric_readers=[reader])
+metrics.set_meter_provider(meter_provider)
+
+# Optional upper bound on the number of quota series exported per project,
+# set with QUOTAS_MAX_SERIES. Unset (the default) exports every series; the
+# per-project snapshots already keep memory proportional to current series.
+MAX_QUOTA_SERIES_PER_PROJECT = int(os.environ.get("QUOTAS_MAX_SERIES", 0)) or None
+
+# Projects currently over the series cap, so the warning is printed once
+# when a project goes over rather than on every poll
+_projects_over_cap = set()
+
+# Create a meter
+meter = metrics.get_meter("QuotaMetrics")
+
+# Latest poll snapshot for each project: project_id -> {combined data key:
+# (attributes, usage, limit)}. Each successful poll replaces its project's
+# snapshot as a whole, and the gauge callbacks below read it on every export.
+latest_quota_values = {}
+
+def observe_current_usage(options):
+    """Reports the latest usage of every known quota series."""
+    # Snapshots are replaced rather than mutated, so a copy of the outer
+    # dict is enough to iterate safely while polls update it
+    for snapshot in list(latest_quota_values.values()):
+        for labels, usage, _ in snapshot.values():
+            yield Observation(usage, attributes=labels)
+
+def observe_quota_limit(options):
+    """Reports the latest limit of every known quota series."""
+    for snapshot in list(latest_quota_values.values()):
+        for labels, _, limit in snapshot.values():
+            yield Observation(limit, attributes=labels)
+
+# Define gauges for usage and limits
+current_usage_gauge = meter.create_observable_gauge(
+    name="gcp_quota_current_usage",
+    callbacks=[observe_current_usage],
+    description="Current usage of GCP quotas",
+    unit="1"
+)
+quota_limit_gauge = meter.create_observable_gauge(
+    name="gcp_quota_limit",
+    callbacks=[observe_quota_limit],
+    description="Quota limit of GCP quotas",
+    unit="1"
+)
+
+# --- Functions ---
+
+def get_monitoring_client():
+    """Returns the shared Cloud Monitoring client, creating it on first use."""
+    global _monitoring_client
+    if _monitoring_client is None:
+        _monitoring_client = monitoring_v3.MetricServiceAsyncClient()
+    return _monitoring_client
+
+def get_request_semaphore():
+    """Returns the semaphore limiting in-flight requests, creating it on first use."""
+    global _request_semaphore
+    if _request_semaphore is None:
+        _request_semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    return _request_semaphore
+
+def build_metric_filter(metric_types):
+    """Returns a Cloud Monitoring filter matching any of the given metric types."""
+    return "metric.type = one_of({})".format(", ".join(f'"{m}"' for m in metric_types))
+
+def read_project_configs_from_csv(file_path, require_interval=True):
+    """Reads project configs (ID, interval, metrics) from a CSV file.
+
+    The metrics_to_check column is optional; projects without it are checked
+    for both allocation and rate quotas. Callers that schedule projects
+    externally pass require_interval=False, in which case the interval
+    column is not required and is ignored.
+    """
+    try:
+        with open(file_path, newline='') as f:
+            reader = csv.DictReader(f)
+            required_cols = ['project_id', 'interval'] if require_interval else ['project_id']
+            if not all(col in (reader.fieldnames or []) for col in required_cols):
+                raise ValueError(f"CSV file must have the following columns: {required_cols}")
+            configs = list(reader)
+        # Precompute per-project values that are invariant across polling cycles
+        for config in configs:
+            metrics_to_check = config.get('metrics_to_check') or DEFAULT_METRICS_TO_CHECK
+            config['_metrics_set'] = frozenset(m.strip().lower() for m in metrics_to_check.split(','))
+            if require_interval:
+                config['_interval'] = float(config['interval'])
+            config['_name'] = f"projects/{config['project_id']}"
+
+            # Quota types to check and the filters that request their usage,
+            # with and without the limits
+            quota_types = tuple(t for t in USAGE_METRICS_BY_QUOTA_TYPE if t in config['_metrics_set'])
+            usage_metric_types = tuple(USAGE_METRICS_BY_QUOTA_TYPE[t] for t in quota_types)
+            config['_quota_types'] = quota_types
+            config['_usage_filter'] = build_metric_filter(usage_metric_types)
+            config['_usage_and_limit_filter'] = build_metric_filter(usage_metric_types + (QUOTA_LIMIT_METRIC,))
+        return configs
+    except FileNotFoundError:
+        print(f"Error: Configuration file not found at '{file_path}'")
+        return []
+
+def get_limit_quota_type(quota_metric):
+    """Returns the quota type of a limit based on the path segments of its quota metric.
+
+    Only a whole "rate" segment marks a rate quota, so allocation quotas whose
+    names merely contain "rate" (e.g. "migration-rate-limited") are not mislabeled.
+    """
+    segments = (quota_metric or "").split("/")
+    return "rate" if "rate" in segments[1:-1] else "allocation"
+
+async def fetch_all(project_name, metric_filter, window_seconds):
+    """Fetches usage and limit data matching a metric filter in a single request.
+
+    project_name is the "projects/<id>" resource name and metric_filter is
+    built with build_metric_filter(); both are precomputed per project. Only
+    points from the last window_seconds are requested, but usage series whose
+    newest point is older than USAGE_WINDOW_SECONDS are always skipped so the
+    wider limit window does not change which usage series are reported.
+    """
+    client = get_monitoring_client()
+    end_time = int(time.time())
+    start_time = end_time - window_seconds
+    usage_cutoff = end_time - USAGE_WINDOW_SECONDS
+    # Usage and limit values keyed by (quota_metric, location, project_id, type)
+    allocation_usage, rate_usage, limit_data = {}, {}, {}
+    async with get_request_semaphore():
+        response = await client.list_time_series(
+            request={
+                "name": project_name,
+                "filter": metric_filter,
+                "interval": {
+                    "end_time": {"seconds": end_time},
+                    "start_time": {"seconds": start_time},
+                },
+            }
+        )
+        async for time_series in response:
+            metric_type = time_series.metric.type
+            # Label values come from a small set, so intern them to share one
+            # string per value and make key hashing and comparison cheap
+            quota_metric = intern(time_series.metric.labels.get("quota_metric") or "")
+            resource_labels = time_series.resource.labels
+            location = intern(resource_labels.get("location") or "")
+            series_project_id = intern(resource_labels.get("project_id") or "")
+            # Dispatch each series to its bucket by metric type
+            if metric_type == QUOTA_LIMIT_METRIC:
+                bucket = limit_data
+                quota_type = get_limit_quota_type(quota_metric)
+            elif metric_type == ALLOCATION_USAGE_METRIC:
+                bucket = allocation_usage
+                quota_type = "allocation"
+            elif metric_type == RATE_USAGE_METRIC:
+                bucket = rate_usage
+                quota_type = "rate"
+            else:
+                continue
+            # The key is the same for every point in the series, so build it once
+            key = (quota_metric, location, series_project_id, quota_type)
+            # Points are returned newest first and only the latest value is used
+            if not time_series.points:
+                continue
+            point = time_series.points[0]
+            if bucket is not limit_data and point.interval.end_time.timestamp() < usage_cutoff:
+                continue
+            bucket[key] = point.value.int64_value
+    return allocation_usage, rate_usage, limit_data
+
+def combine_usage_and_limit(allocation_usage_data, rate_usage_data, limit_data, quota_types=("allocation", "rate")):
+    """Combines usage and limit data for the requested quota types."""
+    # The fetched data is already keyed by series, so each usage entry picks
+    # up its limit with one lookup while the dict is built
+    combined = {
+        key: {"usage": usage, "limit": limit_data.get(key), "type": key[3]}
+        for key, usage in itertools.chain(allocation_usage_data.items(), rate_usage_data.items())
+    }
+
+    # Add limits without a usage series, but only for a requested usage type
+    for key, limit in limit_data.items():
+        if key not in combined and key[3] in quota_types:
+            combined[key] = {"usage": None, "limit": limit, "type": key[3]}
+    return combined
+
+def build_series_attributes(key):
+    """Returns the OTLP attributes for a combined data key."""
+    quota_metric, region, project, quota_type = key
+    return {
+        "quota_metric": quota_metric or "N/A",
+        "region": region or "global",
+        "project": project or "N/A",
+        "type": quota_type or "N/A"
+    }
+
+def update_otlp_metrics(project_id, combined_data):
+    """Replaces a project's quota snapshot for the next OTLP export.
+
+    Series missing from combined_data stop being exported. Attribute dicts
+    are reused from the previous snapshot for series that are still present.
+    """
+    previous = latest_quota_values.get(project_id, {})
+
+    series_keys = combined_data.keys()
+    if MAX_QUOTA_SERIES_PER_PROJECT is not None and len(series_keys) > MAX_QUOTA_SERIES_PER_PROJECT:
+        # Keep a stable subset so the same series are exported on every poll
+        series_keys = sorted(series_keys)[:MAX_QUOTA_SERIES_PER_PROJECT]
+        if project_id not in _projects_over_cap:
+            _projects_over_cap.add(project_id)
+            print(f"Warning: project {project_id} reported {len(combined_data)} quota series; "
+                  f"only {MAX_QUOTA_SERIES_PER_PROJECT} are exported (see QUOTAS_MAX_SERIES).")
+    else:
+        _projects_over_cap.discard(project_id)
+
+    snapshot = {}
+    for key in series_keys:
+        data = combined_data[key]
+        entry = previous.get(key)
+        labels = entry[0] if entry is not None else build_series_attributes(key)
+        usage = data["usage"]
+        limit = data["limit"]
+        snapshot[key] = (
+            labels,
+            usage if usage is not None else 0,
+            limit if limit is not None else -1,
+        )
+    latest_quota_values[project_id] = snapshot
+
+async def fetch_and_process_project(config):
+    """Fetches and processes specified quota data for a single project."""
+    project_id = config['project_id']
+    metrics_to_check = config['_metrics_set']
+    
+    print(f"Fetching metrics for project: {project_id} (checking: {list(metrics_to_check)})")
+    
+    # Only fetch limits if we're checking at least one usage type
+    quota_types = config['_quota_types']
+    if not quota_types:
+        print(f"No valid metrics specified for project: {project_id}. Skipping.")
+        return
+
+    # Only include limits in the request when the cached copy has expired
+    cached_limits = _limit_cache.get(project_id)
+    refresh_limits = cached_limits is None or time.time() - cached_limits[0] > LIMIT_CACHE_TTL
+    # Usage-only requests can use the shorter usage window
+    if refresh_limits:
+        metric_filter, window_seconds = config['_usage_and_limit_filter'], LIMIT_WINDOW_SECONDS
+    else:
+        metric_filter, window_seconds = config['_usage_filter'], USAGE_WINDOW_SECONDS
+
+    try:
+        allocation_usage, rate_usage, limit_data = await fetch_all(config['_name'], metric_filter, window_seconds)
+        if refresh_limits:
+            _limit_cache[project_id] = (time.time(), limit_data)
+        else:
+            limit_data = cached_limits[1]
+        
+        combined_data = combine_usage_and_limit(allocation_usage, rate_usage, limit_data, quota_types)
+        update_otlp_metrics(project_id, combined_data)
+        
+        print(f"Successfully processed project: {project_id}")
+    except Exception as e:
+        print(f"An error occurred while processing project {project_id}: {e}")